@@ -1,18 +1,22 @@
 # http://www.peterbe.com/plog/premailer.py
 from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 import os
 import re
 import sys
+import threading
 import urlparse
 
 import cssutils
+import cssutils.helper
+import cssutils.util
 from lxml.cssselect import CSSSelector
 import lxml.html as etree
 import yaml
 
 __version__ = '1.9'
 
-__all__ = ['PremailerError', 'Premailer', 'transform']
+__all__ = ['PremailerError', 'Premailer', 'shutdown_pools', 'transform']
 
 CLIENT_SUPPORT_YAML = os.path.join(os.path.dirname(__file__), 'data',
                                    'client_support.yaml')
@@ -37,6 +41,58 @@ PARSABLE_PSEUDOCLASSES = [
     'nth-of-type',
 ]
 
+# worker pools shared by all Premailer instances, keyed by process id and size.
+# They are created on first use and kept around so that transform() doesn't
+# pay for starting and joining threads on every call. The process id is part of
+# the key because the threads of a pool don't survive a fork.
+MAX_POOLS = 4
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _get_pool(workers):
+    pid = os.getpid()
+    with _pools_lock:
+        for key in _pools.keys():
+            if key[0] != pid:
+                # inherited from the parent process, its threads are gone
+                del _pools[key]
+        if (pid, workers) not in _pools:
+            if len(_pools) >= MAX_POOLS:
+                # retire the smallest pool; close() lets its workers finish
+                # whatever they are doing without blocking this thread
+                _pools.pop(min(_pools)).close()
+            _pools[(pid, workers)] = ThreadPool(workers)
+        return _pools[(pid, workers)]
+
+
+def shutdown_pools():
+    """Stop the worker threads used by Premailer instances with workers > 1.
+    New pools are started again when they are needed.
+    """
+    pid = os.getpid()
+    with _pools_lock:
+        pools = [_pools.pop(key) for key in _pools.keys() if key[0] == pid]
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+        pool.join()
+
+
+def _chunks(items, count):
+    """Split items into (at most) count contiguous chunks of roughly equal
+    size, keeping their order.
+    """
+    size, extra = divmod(len(items), count)
+    chunks = []
+    start = 0
+    for i in range(count):
+        end = start + size + (i < extra)
+        if end > start:
+            chunks.append(items[start:end])
+        start = end
+    return chunks
+
 
 class PremailerError(Exception):
     pass
@@ -50,7 +106,8 @@ class Premailer(object):
                  include_star_selectors=False,
                  external_styles=[],
                  support_warnings=False,
-                 keep_classnames=[]):
+                 keep_classnames=[],
+                 workers=1):
         self.html = html
         self.base_url = base_url
         self.preserve_internal_links = preserve_internal_links
@@ -67,6 +124,9 @@ class Premailer(object):
             self.support_matrix = \
                 yaml.load(open(CLIENT_SUPPORT_YAML))
         self.keep_classnames = set(keep_classnames)
+        # number of threads used to match selectors against the document
+        # (1 means everything is serial)
+        self.workers = workers
 
     def _check_style_support(self, style):
         for prop in style.getProperties():
@@ -92,8 +152,31 @@ class Premailer(object):
     def _split_selector(self, selector_text):
         return re.split(':', selector_text, 1)
 
+    def _map(self, func, items):
+        """Like the builtin map(), but spread across the worker pool when
+        there are several workers. Results keep the order of items.
+        """
+        if self.workers <= 1 or len(items) < 2:
+            return map(func, items)
+        return _get_pool(self.workers).map(func, items)
+
+    def _match_selectors(self, page, selectors):
+        """Return the list of elements in page matched by each of the
+        selectors, in the same order as selectors. With more than one worker
+        the selectors are split into one chunk per worker.
+        """
+        def match(chunk):
+            return [CSSSelector(sel_text)(page) for sel_text in chunk]
+
+        matches = []
+        for chunk_matches in self._map(match,
+                                       _chunks(selectors, self.workers)):
+            matches.extend(chunk_matches)
+        return matches
+
     def _parse_stylesheet(self, page, stylesheet):
         leftovers = []
+        selectors = []
         for rule in stylesheet.cssRules:
             if rule.type == cssutils.css.CSSRule.STYLE_RULE:
                 if self.support_warnings:
@@ -122,14 +205,37 @@ class Premailer(object):
                             leftovers.append(style_rule)
                             continue
 
-                    css_selector = CSSSelector(sel_text)
-                    for item in css_selector(page):
-                        if pseudoclass:
-                            self.styles[item].append((pseudoclass, style))
-                        else:
-                            self.styles[item].append(style)
+                    selectors.append((sel_text, pseudoclass, style))
+
+        # the selectors are matched (possibly concurrently) first and only
+        # then merged into self.styles, in source order, so that the result
+        # is the same as when they are matched one after the other.
+        matches = self._match_selectors(page, [sel[0] for sel in selectors])
+        for (sel_text, pseudoclass, style), items in zip(selectors, matches):
+            for item in items:
+                if pseudoclass:
+                    self.styles[item].append((pseudoclass, style))
+                else:
+                    self.styles[item].append(style)
         return leftovers
 
+    def _read_external_stylesheet(self, stylefile):
+        """Return the text, encoding and href of an external stylesheet
+        without parsing it.
+        """
+        if stylefile.startswith('http://'):
+            # same as cssutils.parseUrl() does before it parses
+            encoding, enctype, text = cssutils.util._readUrl(stylefile)
+            return text, encoding, stylefile
+        elif os.path.exists(stylefile):
+            # same as cssutils.parseFile() does before it parses
+            with open(stylefile, 'rb') as f:
+                text = f.read()
+            return text, None, cssutils.helper.path2url(stylefile)
+        else:
+            raise ValueError(u'Could not find external style: %s' % \
+                             stylefile)
+
     def transform(self, pretty_print=True):
         """change the self.html and return it with CSS turned into style
         attributes.
@@ -165,14 +271,15 @@ class Premailer(object):
                 parent_of_style = style.getparent()
                 parent_of_style.remove(style)
 
-        for stylefile in self.external_styles:
-            if stylefile.startswith('http://'):
-                self._parse_stylesheet(page, cssutils.parseUrl(stylefile))
-            elif os.path.exists(stylefile):
-                self._parse_stylesheet(page, cssutils.parseFile(stylefile))
-            else:
-                raise ValueError(u'Could not find external style: %s' % \
-                                 stylefile)
+        # the stylesheets are fetched concurrently, but cssutils parsers swap
+        # the global cssutils.log.raiseExceptions while they run, so they are
+        # parsed one at a time.
+        sources = self._map(self._read_external_stylesheet,
+                            self.external_styles)
+        for text, encoding, href in sources:
+            stylesheet = cssutils.parseString(text, encoding=encoding,
+                                              href=href)
+            self._parse_stylesheet(page, stylesheet)
 
         for element, rules in self.styles.iteritems():
             rules += [element.attrib.get('style', '')]
@@ -0,0 +1,14 @@
+import os
+
+
+def write_stylesheets(dirname, stylesheets):
+    """Write each of the stylesheets to its own file in dirname and return
+    the filenames, in the same order.
+    """
+    stylefiles = []
+    for i, css in enumerate(stylesheets):
+        stylefile = os.path.join(dirname, 'style%d.css' % i)
+        with open(stylefile, 'w') as f:
+            f.write(css)
+        stylefiles.append(stylefile)
+    return stylefiles
@@ -8,14 +8,20 @@ This test verifies that CSS styles properly merges inline with DOM elements.
 from cStringIO import StringIO
 import os
 import re
+import shutil
+import signal
 import sys
+import tempfile
+
+import cssutils
 
 if sys.version_info >= (2, 7):
     import unittest
 else:
     import unittest2 as unittest
 
-from premailer import Premailer, etree, transform
+from premailer import Premailer, _chunks, etree, shutdown_pools, transform
+from premailer.test import write_stylesheets
 
 BASE_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
                              'data')
@@ -199,5 +205,78 @@ none}">Add this to your calendar''', result_html)
         leading/trailing semicolons."""
         self.assert_transformed_files_equal('declaration_trailing_comment')
 
+    @unittest.skipIf(not etree, 'ElementTree is required')
+    def test_parallel_workers(self):
+        """Ensure that matching selectors with a pool of workers yields the
+        same output as the serial path."""
+        for name, kwargs in [('basic', {}),
+                             ('css_with_pseudoclasses_excluded',
+                              {'exclude_pseudoclasses': True}),
+                             ('duplicate_property_removal', {}),
+                             ('class_removal', {})]:
+            html = self.read_html_file('test_%s' % name)
+            serial_html = Premailer(html, **kwargs).transform()
+            parallel_html = Premailer(html, workers=4, **kwargs).transform()
+            self.assertEqual(serial_html, parallel_html)
+
+    @unittest.skipIf(not etree, 'ElementTree is required')
+    def test_external_styles_order_with_workers(self):
+        """Ensure that external stylesheets fetched by several workers are
+        applied in the order they were given."""
+        html = """<html>
+<head></head>
+<body><h1 class="a">Hi</h1><p class="b">There</p></body>
+</html>"""
+        dirname = tempfile.mkdtemp()
+        raise_exceptions = cssutils.log.raiseExceptions
+        try:
+            stylefiles = write_stylesheets(dirname, [
+                'h1{color:red} p{margin:0}',
+                'h1{color:blue} .b{padding:0}',
+                '.a{font-size:10px} p{margin:1px}',
+            ])
+            serial_html = Premailer(html,
+                                    external_styles=stylefiles).transform()
+            parallel_html = Premailer(html, external_styles=stylefiles,
+                                      workers=3).transform()
+            self.assertEqual(raise_exceptions, cssutils.log.raiseExceptions)
+        finally:
+            cssutils.log.raiseExceptions = raise_exceptions
+            shutil.rmtree(dirname)
+        self.assertEqual(serial_html, parallel_html)
+        self.assertIn('color:blue', parallel_html)
+        self.assertIn('margin:1px', parallel_html)
+
+    def test_chunks(self):
+        """Ensure that selectors are split into ordered chunks for the
+        workers."""
+        self.assertEqual([], _chunks([], 3))
+        self.assertEqual([[1], [2]], _chunks([1, 2], 4))
+        self.assertEqual([[1, 2], [3, 4], [5]], _chunks([1, 2, 3, 4, 5], 3))
+        self.assertEqual([[1, 2, 3]], _chunks([1, 2, 3], 1))
+
+    @unittest.skipIf(not etree, 'ElementTree is required')
+    @unittest.skipIf(not hasattr(os, 'fork'), 'os.fork is required')
+    def test_workers_after_fork(self):
+        """Ensure that a forked process doesn't reuse the worker pool of its
+        parent, whose threads don't exist in the child."""
+        html = self.read_html_file('test_basic')
+        expected_html = Premailer(html, workers=2).transform()
+        pid = os.fork()
+        if pid == 0:
+            # never let a hanging child block the test run
+            signal.alarm(5)
+            try:
+                result_html = Premailer(html, workers=2).transform()
+                os._exit(0 if result_html == expected_html else 1)
+            except:
+                os._exit(2)
+        try:
+            _, status = os.waitpid(pid, 0)
+        finally:
+            shutdown_pools()
+        self.assertTrue(os.WIFEXITED(status), 'the child process hung')
+        self.assertEqual(0, os.WEXITSTATUS(status))
+
 if __name__ == '__main__':
         unittest.main()
@@ -0,0 +1,224 @@
+#! /usr/bin/env python
+"""
+This test generates random HTML/CSS documents and verifies that every
+optimized mode of Premailer.transform() yields exactly the same output as the
+reference transform. The reference is ReferencePremailer, which replaces the
+parallel helpers of Premailer with the plain serial code. Everything else
+(_parse_stylesheet(), transform() itself) is shared with the optimized modes,
+so a fast path added to that shared code changes both sides and is not caught
+here unless ReferencePremailer is extended to bypass it as well.
+
+Set PREMAILER_FUZZ_TIMING_RUNS to also time every mode (best of that many
+runs) and report the ones noticeably slower than the reference.
+
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+if sys.version_info >= (2, 7):
+    import unittest
+else:
+    import unittest2 as unittest
+
+from lxml.cssselect import CSSSelector
+
+from premailer import Premailer, etree
+from premailer.test import write_stylesheets
+
+# set PREMAILER_FUZZ_SEEDS to run a larger number of documents
+SEEDS = range(int(os.environ.get('PREMAILER_FUZZ_SEEDS', 10)))
+# when set, every transform is timed this many times and the best time is kept
+TIMING_RUNS = int(os.environ.get('PREMAILER_FUZZ_TIMING_RUNS', 0))
+# modes slower than the reference by more than this ratio are reported
+SLOWER_THRESHOLD = 1.2
+# every fast path (Premailer keyword arguments) that must produce output
+# identical to ReferencePremailer
+OPTIMIZED_MODES = [
+    {},
+    {'workers': 2},
+    {'workers': 4},
+]
+
+TAGS = ['div', 'p', 'span', 'a', 'h1', 'td']
+CLASSNAMES = ['a', 'b', 'c', 'header', 'footer']
+PSEUDOCLASSES = [':hover', ':visited', ':first-child', ':last-child',
+                 '::first-letter']
+PROPERTIES = [
+    ('color', ['red', 'blue', '#eee']),
+    ('background-color', ['#fff', 'green']),
+    ('text-align', ['left', 'center']),
+    ('width', ['10px', '50%']),
+    ('margin', ['0', '1px 2px']),
+    ('font-size', ['11px', '2em']),
+]
+BASE_URLS = [None, 'http://example.com', 'http://example.com/path/']
+
+
+def random_selector(rng):
+    if rng.random() < 0.1:
+        selector = '*'
+    else:
+        selector = rng.choice(TAGS)
+        if rng.random() < 0.5:
+            selector += '.%s' % rng.choice(CLASSNAMES)
+    if rng.random() < 0.3:
+        selector = '%s %s' % (rng.choice(TAGS), selector)
+    if rng.random() < 0.3:
+        selector += rng.choice(PSEUDOCLASSES)
+    return selector
+
+
+def random_declarations(rng):
+    declarations = []
+    for i in range(rng.randint(1, 4)):
+        name, values = rng.choice(PROPERTIES)
+        declarations.append('%s:%s' % (name, rng.choice(values)))
+        if rng.random() < 0.2:  # duplicate property
+            declarations.append('%s:%s' % (name, rng.choice(values)))
+    css = ';'.join(declarations)
+    if rng.random() < 0.3:
+        css += ';'
+    if rng.random() < 0.2:  # trailing comment
+        css += ' /* comment */'
+    return css
+
+
+def random_stylesheet(rng):
+    rules = []
+    for i in range(rng.randint(1, 10)):
+        selectors = [random_selector(rng)
+                     for j in range(rng.randint(1, 3))]
+        rules.append('%s { %s }' % (', '.join(selectors),
+                                    random_declarations(rng)))
+    return '\n'.join(rules)
+
+
+def random_element(rng, depth=0):
+    tag = rng.choice(TAGS)
+    attributes = []
+    if rng.random() < 0.6:
+        classes = rng.sample(CLASSNAMES, rng.randint(1, 2))
+        attributes.append('class="%s"' % ' '.join(classes))
+    if rng.random() < 0.2:
+        attributes.append('style="%s"' % random_declarations(rng))
+    if tag == 'a':
+        attributes.append('href="%s"' % rng.choice(['/', '#top', 'page.html',
+                                                    'http://example.org/',
+                                                    'mailto:a@example.com']))
+    children = ''
+    if depth < 2:
+        children = ''.join(random_element(rng, depth + 1)
+                           for i in range(rng.randint(0, 3)))
+    if tag == 'td':
+        return '<table><tr><td %s>Text%s</td></tr></table>' % \
+            (' '.join(attributes), children)
+    return '<%s %s>Text%s</%s>' % (tag, ' '.join(attributes), children, tag)
+
+
+def random_document(rng):
+    """Return some random HTML and a list of random external stylesheets."""
+    styles = ''.join('<style type="text/css">%s</style>' %
+                     random_stylesheet(rng)
+                     for i in range(rng.randint(1, 3)))
+    body = ''.join(random_element(rng) for i in range(rng.randint(1, 5)))
+    if rng.random() < 0.3:
+        body += '<img src="/image.png">'
+    html = '<html><head>%s</head><body>%s</body></html>' % (styles, body)
+    external_styles = [random_stylesheet(rng)
+                       for i in range(rng.randint(0, 4))]
+    return html, external_styles
+
+
+def random_options(rng):
+    return {
+        'base_url': rng.choice(BASE_URLS),
+        'preserve_internal_links': rng.random() < 0.5,
+        'exclude_pseudoclasses': rng.random() < 0.5,
+        'keep_style_tags': rng.random() < 0.5,
+        'include_star_selectors': rng.random() < 0.5,
+        'keep_classnames': rng.sample(CLASSNAMES, rng.randint(0, 2)),
+    }
+
+
+class ReferencePremailer(Premailer):
+    """Premailer without any of its optimizations."""
+
+    def __init__(self, html, **kwargs):
+        kwargs['workers'] = 1
+        super(ReferencePremailer, self).__init__(html, **kwargs)
+
+    def _map(self, func, items):
+        return [func(item) for item in items]
+
+    def _match_selectors(self, page, selectors):
+        return [CSSSelector(sel_text)(page) for sel_text in selectors]
+
+
+def timed_transform(premailer_class, html, **kwargs):
+    """Return the transformed html and the best time of TIMING_RUNS runs (or
+    None when timing is turned off).
+    """
+    result_html = premailer_class(html, **kwargs).transform()
+    best_time = None
+    for i in range(TIMING_RUNS):
+        start = time.time()
+        premailer_class(html, **kwargs).transform()
+        elapsed = time.time() - start
+        if best_time is None or elapsed < best_time:
+            best_time = elapsed
+    return result_html, best_time
+
+
+class PremailerFuzzTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.slower_modes = []
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.slower_modes:
+            worst = max(cls.slower_modes)
+            print >> sys.stderr, '** NOTE: %d of %d optimized runs were ' \
+                  'more than %.0f%% slower than the reference ' \
+                  '(worst: %.1fx, %r with seed %d)' % \
+                  (len(cls.slower_modes), len(SEEDS) * len(OPTIMIZED_MODES),
+                   (SLOWER_THRESHOLD - 1) * 100, worst[0], worst[1], worst[2])
+
+    @unittest.skipIf(not etree, 'ElementTree is required')
+    def test_optimized_modes_match_reference(self):
+        """Ensure that every optimized mode produces byte-identical output to
+        the reference transform for randomly generated documents."""
+        for seed in SEEDS:
+            rng = random.Random(seed)
+            html, external_styles = random_document(rng)
+            options = random_options(rng)
+            dirname = tempfile.mkdtemp()
+            try:
+                options['external_styles'] = \
+                    write_stylesheets(dirname, external_styles)
+                self.check_modes(seed, html, options)
+            finally:
+                shutil.rmtree(dirname)
+
+    def check_modes(self, seed, html, options):
+        expected_html, reference_time = \
+            timed_transform(ReferencePremailer, html, **options)
+        for mode in OPTIMIZED_MODES:
+            kwargs = dict(options, **mode)
+            result_html, mode_time = timed_transform(Premailer, html, **kwargs)
+            self.assertEqual(expected_html, result_html,
+                             'seed %d: %r differs from the reference '
+                             'with options %r' % (seed, mode, options))
+            if reference_time and \
+                    mode_time > reference_time * SLOWER_THRESHOLD:
+                self.slower_modes.append((mode_time / reference_time,
+                                          mode, seed))
+
+if __name__ == '__main__':
+        unittest.main()